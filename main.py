@@ -1,7 +1,11 @@
-import contextlib
-import json
+import functools
+import heapq
+import mmap
 from pathlib import Path
 
+import ahocorasick
+import numpy as np
+import orjson
 import polars as pl
 
 # Soviet/post-Soviet countries with Hebrew names and flag emojis
@@ -45,233 +49,322 @@ COLOR_MODES = [
     "survivor_score",
 ]
 
+# Per-country property names, in SOVIET_COUNTRIES order
+ORIGIN_KEYS = tuple(f"{c}_origin_pct" for c in SOVIET_COUNTRIES)
+BIRTH_KEYS = tuple(f"{c}_birth_pct" for c in SOVIET_COUNTRIES)
+
+# Percentage properties, all in [0, 100] with one decimal, stored as Float32.
+# The Soviet totals are unrounded sums and stay Float64 so they publish exactly
+PCT_KEYS = (*ORIGIN_KEYS, *BIRTH_KEYS, "elderly_pct", "very_elderly_pct")
+
+# Entry with all countries set to 0, plus demographic fields
+ZERO_ENTRY = {
+    **dict.fromkeys(ORIGIN_KEYS + BIRTH_KEYS, 0.0),
+    "population": 0,
+    "median_age": 0.0,
+    "elderly_pct": 0.0,
+    "very_elderly_pct": 0.0,  # 75+ in 2022 census = born before 1947
+    "soviet_origin_count": 0,
+    "soviet_birth_count": 0,
+    "survivor_score": 0.0,
+}
 
-def match_soviet_country(country_name):
-    """Match a Hebrew country name to a Soviet country key."""
-    if not country_name:
-        return None
-    country_name = str(country_name).strip()
-    for key, info in SOVIET_COUNTRIES.items():
-        if info["he"] in country_name or country_name in info["he"]:
-            return key
-    return None
+# Properties for GeoJSON features without census data, in census column order
+DEFAULT_PROPS = {**ZERO_ENTRY, "soviet_origin_pct": 0.0, "soviet_birth_pct": 0.0}
 
+# Number of areas listed per color mode
+TOP_AREAS_COUNT = 20
 
-def parse_yishuv_sta(semel, stat_area):
-    """Parse settlement code and stat area into YISHUV_STA key."""
-    if semel is None or stat_area is None:
-        return None
-    with contextlib.suppress(ValueError, TypeError):
-        semel_int = int(float(semel))
-        stat_int = int(float(stat_area))
-        return f"{semel_int}{stat_int:04d}"
-    return None
-
-
-def extract_country_pct(row, country_col, pct_col, suffix):
-    """Extract country percentage from a row if valid."""
-    if country_col >= len(row) or pct_col >= len(row):
-        return None, None
-    country_name = row[country_col]
-    pct = row[pct_col]
-    country_key = match_soviet_country(country_name)
-    if country_key and pct is not None:
-        with contextlib.suppress(ValueError, TypeError):
-            return f"{country_key}_{suffix}", float(pct)
-    return None, None
-
-
-def init_entry():
-    """Initialize an entry with all countries set to 0."""
-    entry = {f"{c}_origin_pct": 0.0 for c in SOVIET_COUNTRIES}
-    entry.update({f"{c}_birth_pct": 0.0 for c in SOVIET_COUNTRIES})
-    # Add demographic fields
-    entry["population"] = 0
-    entry["median_age"] = 0.0
-    entry["elderly_pct"] = 0.0
-    entry["very_elderly_pct"] = 0.0  # 75+ in 2022 census = born before 1947
-    entry["soviet_origin_count"] = 0
-    entry["soviet_birth_count"] = 0
-    entry["survivor_score"] = 0.0
-    return entry
+# Census (country, pct) column pairs: top-4 origin and top-3 birth countries
+ORIGIN_COLS = [(61 + i * 2, 62 + i * 2) for i in range(4)]
+BIRTH_COLS = [(69 + i * 2, 70 + i * 2) for i in range(3)]
 
 
-def parse_float(val):
-    """Safely parse a float value."""
-    if val is None or val == "":
-        return None
-    with contextlib.suppress(ValueError, TypeError):
-        return float(val)
-    return None
+def build_country_automaton():
+    """Build an Aho-Corasick automaton over the Hebrew country names."""
+    automaton = ahocorasick.Automaton()
+    for order, (key, info) in enumerate(SOVIET_COUNTRIES.items()):
+        automaton.add_word(info["he"], (order, key))
+    automaton.make_automaton()
+    return automaton
 
 
-def process_row(row):
-    """Process a single census row and return (yishuv_sta, entry) or None."""
-    yishuv_sta = parse_yishuv_sta(row[1], row[2])
-    if not yishuv_sta:
+COUNTRY_AUTOMATON = build_country_automaton()
+
+# Every fragment of a Hebrew name, earlier countries taking precedence
+COUNTRY_FRAGMENTS = {
+    he[i:j]: key
+    for key, he in reversed([(k, v["he"]) for k, v in SOVIET_COUNTRIES.items()])
+    for i in range(len(he))
+    for j in range(i + 1, len(he) + 1)
+}
+
+
+def match_soviet_country(country_name):
+    """Match a Hebrew country name to a Soviet country key."""
+    # Blank and whitespace-only cells name no country
+    country_name = str(country_name).strip() if country_name else ""
+    if not country_name:
         return None
+    return match_country_name(country_name)
+
+
+@functools.lru_cache(maxsize=4096)
+def match_country_name(country_name):
+    """Match a stripped Hebrew country name, memoized per distinct name."""
+    # First country (in SOVIET_COUNTRIES order) whose name appears in the cell
+    matches = [value for _, value in COUNTRY_AUTOMATON.iter(country_name)]
+    if matches:
+        return min(matches)[1]
+    # Otherwise the cell may itself be part of a country name
+    return COUNTRY_FRAGMENTS.get(country_name)
+
+
+def float_col(col):
+    """Census column at position col as Float64, null if empty or invalid."""
+    return pl.nth(col).cast(pl.Float64, strict=False)
+
+
+def int_col(col):
+    """Census column at position col truncated to Int64, null if invalid."""
+    return float_col(col).cast(pl.Int64, strict=False)
+
+
+def country_pct(country, cols, country_keys):
+    """Percentage of a country key across (country, pct) column pairs."""
+    # Later pairs overwrite earlier ones, so they take precedence in coalesce
+    return pl.coalesce(
+        pl.when(
+            pl.nth(country_col).replace_strict(country_keys, default=None) == country
+        ).then(float_col(pct_col))
+        for country_col, pct_col in reversed(cols)
+    ).fill_null(0.0)
+
+
+# Columns derive_entry computes per row
+DERIVED_SCHEMA = {
+    "median_age": pl.Float64,
+    "elderly_pct": pl.Float64,
+    "very_elderly_pct": pl.Float64,
+    "soviet_origin_pct": pl.Float64,
+    "soviet_birth_pct": pl.Float64,
+    "soviet_origin_count": pl.Int64,
+    "soviet_birth_count": pl.Int64,
+    "survivor_score": pl.Float64,
+}
 
-    entry = init_entry()
-
-    # Extract demographic data
-    # Col 20: Total population
-    population = parse_float(row[20]) if len(row) > 20 else None
-    entry["population"] = int(population) if population else 0
-
-    # Col 26: Median age
-    median_age = parse_float(row[26]) if len(row) > 26 else None
-    entry["median_age"] = round(median_age, 1) if median_age else 0.0
-
-    # Elderly percentage: sum of cols 39, 40 (male 65-74, 75+) and 48, 49 (female 65-74, 75+)
-    elderly_pct = 0.0
-    for col in [39, 40, 48, 49]:
-        if len(row) > col:
-            val = parse_float(row[col])
-            if val:
-                elderly_pct += val
-    entry["elderly_pct"] = round(elderly_pct, 1)
-
-    # Very elderly (75+ in 2022 = born before 1947, includes Stalinist-era survivors)
-    # Cols 40 and 49 are the oldest age brackets
-    very_elderly_pct = 0.0
-    for col in [40, 49]:
-        if len(row) > col:
-            val = parse_float(row[col])
-            if val:
-                very_elderly_pct += val
-    entry["very_elderly_pct"] = round(very_elderly_pct, 1)
-
-    # Origin columns (4 countries): cols 61,62,63,64,65,66,67,68
-    for i in range(4):
-        key, val = extract_country_pct(row, 61 + i * 2, 62 + i * 2, "origin_pct")
-        if key:
-            entry[key] = val
-
-    # Birth columns (3 countries): cols 69,70,71,72,73,74
-    for i in range(3):
-        key, val = extract_country_pct(row, 69 + i * 2, 70 + i * 2, "birth_pct")
-        if key:
-            entry[key] = val
-
-    # Calculate aggregate soviet totals (percentages)
-    entry["soviet_origin_pct"] = sum(
-        entry.get(f"{c}_origin_pct", 0) for c in SOVIET_COUNTRIES
-    )
-    entry["soviet_birth_pct"] = sum(
-        entry.get(f"{c}_birth_pct", 0) for c in SOVIET_COUNTRIES
-    )
+
+def derive_entry(row):
+    """Round demographics and compute Soviet totals, counts and survivor score."""
+    entry = {
+        "median_age": round(row["median_age"], 1),
+        "elderly_pct": round(row["elderly_pct"], 1),
+        "very_elderly_pct": round(row["very_elderly_pct"], 1),
+        # Calculate aggregate soviet totals (percentages)
+        "soviet_origin_pct": sum(row[k] for k in ORIGIN_KEYS),
+        "soviet_birth_pct": sum(row[k] for k in BIRTH_KEYS),
+        "soviet_origin_count": 0,
+        "soviet_birth_count": 0,
+        "survivor_score": 0.0,
+    }
 
     # Calculate absolute counts
-    if entry["population"] > 0:
+    population = row["population"]
+    if population > 0:
         entry["soviet_origin_count"] = int(
-            entry["population"] * entry["soviet_origin_pct"] / 100
-        )
-        entry["soviet_birth_count"] = int(
-            entry["population"] * entry["soviet_birth_pct"] / 100
+            population * entry["soviet_origin_pct"] / 100
         )
+        entry["soviet_birth_count"] = int(population * entry["soviet_birth_pct"] / 100)
 
-    # Calculate survivor score: combines very elderly % (75+ = born before 1947) and Soviet birth %
-    # Higher score = more likely to find Stalinist-era survivors
-    # Uses very_elderly (75+) not just elderly (65+) for better targeting
+    # Calculate survivor score: combines very elderly % (75+ = born before 1947)
+    # and Soviet birth %. Higher score = more likely to find Stalinist-era
+    # survivors. Uses very_elderly (75+) not just elderly (65+) for better
+    # targeting
     if entry["very_elderly_pct"] > 0 and entry["soviet_birth_pct"] > 0:
         entry["survivor_score"] = round(
             (entry["very_elderly_pct"] * entry["soviet_birth_pct"]) / 10, 1
         )
-
-    return yishuv_sta, entry
+    return entry
 
 
 def load_census_data():
-    """Load and parse census data into country_data dict."""
+    """Load census data: parse and match in Polars, round and total in Python."""
     df = pl.read_csv(CENSUS_PATH, has_header=False, infer_schema=False)
-    country_data = {}
-    for row in df.iter_rows():
-        result = process_row(row)
-        if result:
-            yishuv_sta, entry = result
-            country_data[yishuv_sta] = entry
-    return country_data
 
+    # Match each distinct Hebrew country name once rather than once per row
+    names = df.select(pl.nth(*(c for c, _ in ORIGIN_COLS + BIRTH_COLS))).unpivot()
+    country_keys = {
+        name: key
+        for name in names["value"].unique().drop_nulls()
+        if (key := match_soviet_country(name))
+    }
+
+    lf = (
+        df.lazy()
+        .select(
+            # Cols 1, 2: settlement code and 4-digit stat area -> YISHUV_STA,
+            # an int as in the GeoJSON (settlement 473, area 1 -> 4730001)
+            (int_col(1) * 10000 + int_col(2)).alias("yishuv_sta"),
+            # Col 20: Total population
+            int_col(20).fill_null(0).alias("population"),
+            # Col 26: Median age
+            float_col(26).fill_null(0.0).alias("median_age"),
+            # Elderly percentage: sum of cols 39, 40 (male 65-74, 75+)
+            # and 48, 49 (female 65-74, 75+)
+            sum(float_col(c).fill_null(0.0) for c in [39, 40, 48, 49]).alias(
+                "elderly_pct"
+            ),
+            # Very elderly (75+ in 2022 = born before 1947, includes Stalinist-era
+            # survivors). Cols 40 and 49 are the oldest age brackets
+            sum(float_col(c).fill_null(0.0) for c in [40, 49]).alias(
+                "very_elderly_pct"
+            ),
+            *(
+                country_pct(c, ORIGIN_COLS, country_keys).alias(key)
+                for c, key in zip(SOVIET_COUNTRIES, ORIGIN_KEYS, strict=True)
+            ),
+            *(
+                country_pct(c, BIRTH_COLS, country_keys).alias(key)
+                for c, key in zip(SOVIET_COUNTRIES, BIRTH_KEYS, strict=True)
+            ),
+        )
+        .filter(pl.col("yishuv_sta").is_not_null())
+    )
+    df = lf.collect()
+
+    # Rounding and totals stay per row in Python: Polars rounds scaled values
+    # and sums without compensation, shifting half-way and near-tie results
+    derived = pl.from_dicts(
+        [derive_entry(row) for row in df.iter_rows(named=True)],
+        schema=DERIVED_SCHEMA,
+    )
+    return (
+        df.with_columns(derived.get_columns())
+        .select("yishuv_sta", *DEFAULT_PROPS)
+        # Counts and scores above use Float64; stored percentages fit Float32
+        .with_columns(pl.col(PCT_KEYS).cast(pl.Float32))
+        # Duplicate keys keep the last row
+        .unique(subset="yishuv_sta", keep="last", maintain_order=True)
+    )
+
+
+def load_geojson():
+    """Load the statistical areas GeoJSON."""
+    # Parse straight from a read-only mapping instead of copying the file into
+    # a bytes object first; the mapping is closed before update_geojson writes
+    with (
+        GEOJSON_PATH.open("rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm,
+        memoryview(mm) as view,
+    ):
+        return orjson.loads(view)
 
-def update_geojson(country_data):
-    """Update GeoJSON with country data, return (geojson, match_count)."""
-    with GEOJSON_PATH.open() as f:
-        geojson = json.load(f)
+
+def update_geojson(geojson, country_data):
+    """Update GeoJSON with country data and save it, return match_count."""
+    # Feature properties are plain dicts, so merge through a per-key row lookup.
+    # Widen percentages back to Float64 at their one decimal so the JSON shows
+    # 5.1 rather than the nearest float32, 5.099999904632568
+    lookup = country_data.with_columns(
+        pl.col(PCT_KEYS).cast(pl.Float64).round(1)
+    ).rows_by_key("yishuv_sta", named=True, unique=True)
 
     matched = 0
     for feature in geojson["features"]:
         props = feature["properties"]
-        yishuv_sta = str(props.get("YISHUV_STA", ""))
+        yishuv_sta = props.get("YISHUV_STA")
+        if isinstance(yishuv_sta, str):
+            yishuv_sta = int(yishuv_sta) if yishuv_sta.isdecimal() else None
+        entry = lookup.get(yishuv_sta)
 
-        if yishuv_sta in country_data:
-            props.update(country_data[yishuv_sta])
+        if entry is not None:
+            props.update(entry)
             matched += 1
         else:
-            props.update(init_entry())
+            props.update(DEFAULT_PROPS)
 
-    with GEOJSON_PATH.open("w") as f:
-        json.dump(geojson, f)
+    GEOJSON_PATH.write_bytes(orjson.dumps(geojson))
 
-    return geojson, matched
+    return matched
 
 
 def get_centroid(geometry):
-    """Calculate centroid of a geometry."""
+    """Calculate centroid of a geometry as a NumPy [x, y] array."""
     coords = []
     if geometry["type"] == "Polygon":
         coords = geometry["coordinates"][0]
     elif geometry["type"] == "MultiPolygon":
         coords = geometry["coordinates"][0][0]
     if not coords:
-        return [0, 0]
-    x = sum(c[0] for c in coords) / len(coords)
-    y = sum(c[1] for c in coords) / len(coords)
-    return [round(x, 6), round(y, 6)]
+        return np.zeros(2)
+    try:
+        points = np.asarray(coords, dtype=np.float64)
+    except ValueError:
+        # Ring mixing 2-D and 3-D vertices; keep x and y of each
+        points = np.array([c[:2] for c in coords], dtype=np.float64)
+    # Ignore Z (or any further ordinates) like the per-vertex c[0], c[1] did
+    return points[:, :2].mean(axis=0).round(6)
 
 
 def compute_top_areas(geojson):
     """Compute top 20 areas for each color mode."""
-    top_areas = {}
-    for mode in COLOR_MODES:
-        areas = []
-        for feature in geojson["features"]:
-            props = feature["properties"]
+    features = geojson["features"]
+    # Single pass over features, keeping a bounded min-heap of (value, -index)
+    # per mode so equal values rank the earlier feature first
+    heaps = {mode: [] for mode in COLOR_MODES}
+    for i, feature in enumerate(features):
+        props = feature["properties"]
+        for mode in COLOR_MODES:
             value = props.get(mode, 0)
             if value and value > 0:
-                name = props.get("SHEM_YIS_1") or props.get("SHEM_YISHU") or "Unknown"
-                center = get_centroid(feature["geometry"])
-                area_data = {
-                    "name": name,
-                    "value": round(value, 2) if isinstance(value, float) else value,
-                    "center": center,
-                }
-                # Add extra context for survivor-related modes
-                if mode in ["survivor_score", "soviet_birth_count", "soviet_origin_count"]:
-                    area_data["population"] = props.get("population", 0)
-                    area_data["elderly_pct"] = props.get("elderly_pct", 0)
-                    area_data["very_elderly_pct"] = props.get("very_elderly_pct", 0)
-                    area_data["soviet_birth_pct"] = props.get("soviet_birth_pct", 0)
-                    area_data["median_age"] = props.get("median_age", 0)
-                areas.append(area_data)
-        areas.sort(key=lambda x: x["value"], reverse=True)
-        top_areas[mode] = areas[:20]
+                value = round(value, 2) if isinstance(value, float) else value
+                heap = heaps[mode]
+                if len(heap) < TOP_AREAS_COUNT:
+                    heapq.heappush(heap, (value, -i))
+                else:
+                    heapq.heappushpop(heap, (value, -i))
+
+    top_areas = {}
+    # Centroids by feature index, shared across color modes
+    centroids = {}
+    for mode, heap in heaps.items():
+        areas = []
+        for value, neg_index in sorted(heap, reverse=True):
+            i = -neg_index
+            props = features[i]["properties"]
+            if i not in centroids:
+                centroids[i] = get_centroid(features[i]["geometry"])
+            name = props.get("SHEM_YIS_1") or props.get("SHEM_YISHU") or "Unknown"
+            area_data = {"name": name, "value": value, "center": centroids[i]}
+            # Add extra context for survivor-related modes
+            if mode in ["survivor_score", "soviet_birth_count", "soviet_origin_count"]:
+                area_data["population"] = props.get("population", 0)
+                area_data["elderly_pct"] = props.get("elderly_pct", 0)
+                area_data["very_elderly_pct"] = props.get("very_elderly_pct", 0)
+                area_data["soviet_birth_pct"] = props.get("soviet_birth_pct", 0)
+                area_data["median_age"] = props.get("median_age", 0)
+            areas.append(area_data)
+        top_areas[mode] = areas
     return top_areas
 
 
 def print_stats(country_data):
     """Print statistics for each country."""
+    # Max and nonzero count for every country column in one aggregation
+    keys = ORIGIN_KEYS + BIRTH_KEYS
+    stats = country_data.select(
+        pl.col(keys).max().fill_null(0).name.suffix("_max"),
+        (pl.col(keys) > 0).sum().name.suffix("_count"),
+    ).row(0, named=True)
+
     print("\nCountry statistics (max values found):")
-    for country, info in SOVIET_COUNTRIES.items():
-        origin_vals = [
-            country_data[k].get(f"{country}_origin_pct", 0) for k in country_data
-        ]
-        birth_vals = [
-            country_data[k].get(f"{country}_birth_pct", 0) for k in country_data
-        ]
-        origin_max = max(origin_vals) if origin_vals else 0
-        birth_max = max(birth_vals) if birth_vals else 0
-        origin_count = sum(1 for v in origin_vals if v > 0)
-        birth_count = sum(1 for v in birth_vals if v > 0)
+    for info, origin_key, birth_key in zip(
+        SOVIET_COUNTRIES.values(), ORIGIN_KEYS, BIRTH_KEYS, strict=True
+    ):
+        origin_max = stats[f"{origin_key}_max"]
+        birth_max = stats[f"{birth_key}_max"]
+        origin_count = stats[f"{origin_key}_count"]
+        birth_count = stats[f"{birth_key}_count"]
         if origin_max > 0 or birth_max > 0:
             print(
                 f"  {info['flag']} {info['en']:15} "
@@ -285,13 +378,15 @@ def main():
     country_data = load_census_data()
     print(f"Processed {len(country_data)} census rows")
 
-    geojson, matched = update_geojson(country_data)
+    geojson = load_geojson()
+    matched = update_geojson(geojson, country_data)
     print(f"Matched {matched} features in GeoJSON")
 
     # Compute and save top areas for each color mode
     top_areas = compute_top_areas(geojson)
-    with TOP_AREAS_PATH.open("w") as f:
-        json.dump(top_areas, f)
+    TOP_AREAS_PATH.write_bytes(
+        orjson.dumps(top_areas, option=orjson.OPT_SERIALIZE_NUMPY)
+    )
     print(f"Saved top areas to {TOP_AREAS_PATH}")
 
     print_stats(country_data)
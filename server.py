@@ -1,8 +1,15 @@
 """Simple HTTP server with Range request support for PMTiles."""
 
 import http.server
+import re
 from pathlib import Path
 
+# Single byte range, e.g. "bytes=0-1023", "bytes=1024-" or the suffix
+# "bytes=-500"; anything else is served as a normal request. Positions are
+# capped at 19 digits, so oversized values fall through to a normal request
+# instead of failing in int()
+_RANGE_RE = re.compile(r"bytes=(\d{0,19})-(\d{0,19})")
+
 
 class RangeHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     def send_head(self):
@@ -17,31 +24,37 @@ class RangeHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         file_size = path.stat().st_size
 
         # Handle Range requests
-        range_header = self.headers.get("Range")
-        if range_header:
-            try:
-                range_spec = range_header.replace("bytes=", "")
-                start, end = range_spec.split("-")
-                start = int(start) if start else 0
-                end = int(end) if end else file_size - 1
-                end = min(end, file_size - 1)
-                length = end - start + 1
-
-                self.send_response(206)
-                self.send_header("Content-type", self.guess_type(path))
-                self.send_header("Content-Length", length)
-                self.send_header(
-                    "Content-Range", f"bytes {start}-{end}/{file_size}"
-                )
-                self.send_header("Accept-Ranges", "bytes")
+        range_match = _RANGE_RE.fullmatch(self.headers.get("Range", ""))
+        if range_match and any(range_match.groups()):
+            start, end = range_match.groups()
+            if start:
+                start = int(start)
+                end = min(int(end), file_size - 1) if end else file_size - 1
+            else:
+                # Suffix range: "bytes=-500" is the last 500 bytes
+                start = max(file_size - int(end), 0)
+                end = file_size - 1
+            # Covers start > end as sent and a start at or past the end of file
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{file_size}")
+                self.send_header("Content-Length", 0)
                 self.send_header("Access-Control-Allow-Origin", "*")
                 self.end_headers()
+                return None
+            length = end - start + 1
+
+            self.send_response(206)
+            self.send_header("Content-type", self.guess_type(path))
+            self.send_header("Content-Length", length)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{file_size}")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
 
-                f = path.open("rb")
-                f.seek(start)
-                return _RangeFile(f, length)
-            except (ValueError, IndexError):
-                pass
+            f = path.open("rb")
+            f.seek(start)
+            return _RangeFile(f, length)
 
         # Normal request
         self.send_response(200)
@@ -52,22 +65,33 @@ class RangeHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         self.end_headers()
         return path.open("rb")
 
+    def copyfile(self, source, outputfile):
+        # socket.sendfile() moves the bytes in the kernel via os.sendfile and
+        # falls back to plain send() for sources without a usable file handle
+        outputfile.flush()
+        if isinstance(source, _RangeFile):
+            # sendfile() rejects a zero count, and an empty range has no body
+            if source.remaining > 0:
+                f = source.f
+                self.connection.sendfile(f, offset=f.tell(), count=source.remaining)
+        else:
+            self.connection.sendfile(source)
+
 
 class _RangeFile:
+    """Holds a file positioned at the range start and the bytes left to send.
+
+    copyfile() hands the underlying file to sendfile(), so it is never read
+    through this wrapper.
+    """
+
     def __init__(self, f, length):
         self.f = f
         self.remaining = length
 
-    def read(self, size=-1):
-        if size < 0:
-            size = self.remaining
-        size = min(size, self.remaining)
-        self.remaining -= size
-        return self.f.read(size)
-
     def close(self):
         self.f.close()
 
 
 if __name__ == "__main__":
-    http.server.HTTPServer(("", 8080), RangeHTTPRequestHandler).serve_forever()
+    http.server.ThreadingHTTPServer(("", 8080), RangeHTTPRequestHandler).serve_forever()